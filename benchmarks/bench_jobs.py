@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+"""
+Benchmark of ``export-kobo.py --jobs``.
+
+Generates synthetic KoboReader.sqlite files with a large single library,
+then exports them with an increasing number of worker processes,
+checking that the output is the same as the one of a single process
+and printing the speedup against ``--jobs 1``.
+
+The libraries generated are:
+
+* ``v174``: database version 174, items joined to their chapter by ContentID;
+* ``v175``: database version 175, items joined by BookID to all the chapters of the book;
+* ``duplicates``: as ``v174``, with some items sharing the same DateCreated,
+  in the same book and across books (``--jobs`` falls back to a single process
+  when the ranges collide, so no speedup is expected).
+
+The list of books is read by a single process before the workers start:
+on the default library it is about 3 s of a 7 s export (version 174),
+so the speedup cannot go above about 2x (about 3x for version 175).
+Measured numbers are in the README.
+
+Usage:
+
+    $ python3 benchmarks/bench_jobs.py
+    $ python3 benchmarks/bench_jobs.py --books 500 --items 400 --jobs 1 2 4 8 --format json --case v175
+"""
+
+import argparse
+import datetime
+import os
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "export-kobo.py")
+
+CHAPTERS = 20
+
+# (database version, fraction of items reusing the DateCreated of a previous item)
+CASES = {
+    "v174": (174, 0.0),
+    "v175": (175, 0.0),
+    "duplicates": (174, 0.01),
+}
+
+
+def make_db(path, books, items, version, duplicates):
+    """
+    Create a KoboReader.sqlite-like file with the given number
+    of books and of items per book.
+    """
+    rnd = random.Random(0)
+    sql_connection = sqlite3.connect(path)
+    sql_connection.executescript("""
+        CREATE TABLE DbVersion (version INTEGER);
+        CREATE TABLE content (ContentID TEXT PRIMARY KEY, BookID TEXT, BookTitle TEXT, Title TEXT, Attribution TEXT);
+        CREATE TABLE Bookmark (
+            BookmarkID TEXT PRIMARY KEY, VolumeID TEXT, ContentID TEXT, Text TEXT, Annotation TEXT,
+            DateCreated TEXT, DateModified TEXT, ChapterProgress REAL
+        );
+        CREATE INDEX bookmark_volume ON Bookmark (VolumeID);
+        CREATE INDEX content_bookid ON content (BookID);
+    """)
+    sql_connection.execute("INSERT INTO DbVersion VALUES (?);", (version,))
+    start = datetime.datetime(2012, 1, 1)
+    dates = []
+    n = 0
+    with sql_connection:
+        for b in range(books):
+            volumeid = "file:///mnt/onboard/book{:05d}.epub".format(b)
+            title = "Book {}".format(b)
+            sql_connection.execute(
+                "INSERT INTO content VALUES (?, NULL, NULL, ?, ?);",
+                (volumeid, title, "Author {}".format(b % 50))
+            )
+            sql_connection.executemany(
+                "INSERT INTO content VALUES (?, ?, ?, ?, NULL);",
+                [("{}#ch{}".format(volumeid, c), volumeid, title, "Chapter {}".format(c)) for c in range(CHAPTERS)]
+            )
+            rows = []
+            for _ in range(items):
+                n += 1
+                if dates and rnd.random() < duplicates:
+                    date = rnd.choice(dates)
+                else:
+                    # unique dates, as on a real device (millisecond resolution)
+                    date = (start + datetime.timedelta(seconds=rnd.randrange(10 ** 9), milliseconds=n)).isoformat(timespec="milliseconds")
+                    dates.append(date)
+                text = "  Highlighted passage number {} of {}, with some words.  ".format(n, title) if rnd.random() < 0.9 else None
+                annotation = "Note {}".format(n) if rnd.random() < 0.3 else None
+                rows.append((
+                    "bookmark-{:09d}".format(n),
+                    volumeid,
+                    "{}#ch{}".format(volumeid, rnd.randrange(CHAPTERS)),
+                    text,
+                    annotation,
+                    date,
+                    date,
+                    rnd.random(),
+                ))
+            sql_connection.executemany("INSERT INTO Bookmark VALUES (?, ?, ?, ?, ?, ?, ?, ?);", rows)
+    sql_connection.close()
+
+
+def run_export(db_path, output_path, frmt, jobs):
+    """
+    Run the export and return the elapsed time in seconds.
+    """
+    command = [sys.executable, SCRIPT, db_path, "--jobs", str(jobs), "--output", output_path]
+    if frmt != "human":
+        command.append("--" + frmt)
+    start = time.perf_counter()
+    subprocess.run(command, check=True)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark export-kobo.py --jobs")
+    parser.add_argument("--books", type=int, default=300, help="Number of books in the library")
+    parser.add_argument("--items", type=int, default=400, help="Number of items per book")
+    parser.add_argument("--jobs", type=int, nargs="+", default=[1, 2, 4, 8], help="Number of processes to try")
+    parser.add_argument("--format", choices=["human", "csv", "json", "raw"], default="human", help="Output format")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per number of processes (best time is kept)")
+    parser.add_argument("--case", choices=list(CASES), nargs="+", default=list(CASES), help="Libraries to generate")
+    args = parser.parse_args()
+
+    print("{} books, {} items, format {}, {} CPUs".format(args.books, args.books * args.items, args.format, os.cpu_count()))
+    with tempfile.TemporaryDirectory() as tmp:
+        for case in args.case:
+            version, duplicates = CASES[case]
+            db_path = os.path.join(tmp, "{}.sqlite".format(case))
+            make_db(db_path, args.books, args.items, version, duplicates)
+            print()
+            print(case)
+            print("{:>6}  {:>9}  {:>8}".format("jobs", "time (s)", "speedup"))
+
+            reference_path = os.path.join(tmp, "{}.reference.out".format(case))
+            reference = min(run_export(db_path, reference_path, args.format, 1) for _ in range(args.repeat))
+            with open(reference_path, "rb") as f:
+                expected = f.read()
+
+            for jobs in args.jobs:
+                output_path = os.path.join(tmp, "{}.jobs{}.out".format(case, jobs))
+                elapsed = min(run_export(db_path, output_path, args.format, jobs) for _ in range(args.repeat))
+                with open(output_path, "rb") as f:
+                    if f.read() != expected:
+                        sys.exit("ERROR: {} output with --jobs {} differs from --jobs 1".format(case, jobs))
+                print("{:>6}  {:>9.3f}  {:>7.2f}x".format(jobs, elapsed, reference / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,17 @@
 #!/usr/bin/env python3
 
 import argparse
+import contextlib
+import concurrent.futures
 import datetime
 import csv
+import heapq
 import io
 import os
 import sqlite3
 import sys
 import json
+import textwrap
 
 
 DAYS = [
@@ -129,6 +133,13 @@ class Item(object):
     BOOKMARK = "bookmark"
     HIGHLIGHT = "highlight"
 
+    # Small integer codes used to store the kind in the SQLite output
+    KIND_CODES = {
+        BOOKMARK: 0,
+        HIGHLIGHT: 1,
+        ANNOTATION: 2,
+    }
+
     def __init__(self, values, book):
         self.volumeid = values[0]
         self.bookmarkid = values[9]
@@ -173,12 +184,21 @@ class Item(object):
             output = ""
         return output
 
+    @staticmethod
+    def parse_date(date):
+        """
+        Split a Kobo date string, e.g. "2014-12-19T19:54:11.000",
+        into the integers ``(year, month, day, hour, minute, second)``.
+        """
+        p1, p2 = date.split("T")
+        year, month, day = [int(x) for x in p1.split("-")]
+        hour, minute, second = [int(float(x)) for x in p2.split(":")]
+        return (year, month, day, hour, minute, second)
+
     def format_date(self):
         d = "Thursday, 1 January 1970 00:00:00"
         try:
-            p1, p2 = self.datecreated.split("T")
-            year, month, day = [int(x) for x in p1.split("-")]
-            hour, minute, second = [int(float(x)) for x in p2.split(":")]
+            year, month, day, hour, minute, second = self.parse_date(self.datecreated)
             sday = DAYS[datetime.datetime(year=year, month=month, day=day).weekday()]
             smonth = MONTHS[month - 1]
             # e.g. "Friday, 19 December 2014 19:54:11"
@@ -187,6 +207,19 @@ class Item(object):
             pass
         return d
 
+    @staticmethod
+    def parse_timestamp(date):
+        """
+        Return the given Kobo date string as seconds since the epoch (UTC),
+        or None if it is missing or cannot be parsed.
+        """
+        try:
+            year, month, day, hour, minute, second = Item.parse_date(date.rstrip("Z"))
+            d = datetime.datetime(year=year, month=month, day=day, hour=hour, minute=minute, second=second, tzinfo=datetime.timezone.utc)
+            return int(d.timestamp())
+        except:
+            return None
+
     def kindle_my_clippings(self):
         """
         Return a string representing this Item, in the Kindle "My Clippings" format.
@@ -352,6 +385,20 @@ class ExportKobo(CommandLineTool):
           "action": "store_true",
           "help": "Output in raw text instead of human-readable format"
         },
+        {
+            "name": "--sqlite-out",
+            "nargs": None,
+            "type": str,
+            "default": None,
+            "help": "Write books and items into the SQLite file at the given path, updating existing items (cannot be used with the other output options, or with --ui, --list or --jobs)"
+        },
+        {
+            "name": "--jobs",
+            "nargs": "?",
+            "type": int,
+            "default": 1,
+            "help": "Build and format the items using the given number of processes (kindle, JSON, CSV, raw and default formats only)"
+        },
     ]
 
     QUERY_DB_VERSION = "SELECT version FROM DbVersion;"
@@ -363,7 +410,12 @@ class ExportKobo(CommandLineTool):
     # I'm not sure if this is a problem due to some annotation migration or is
     # a bug into the db of Kobo Color model.
     # Once confirmed please fix and use a single query if possible.
-    QUERY_ITEMS_V175 = """
+    #
+    # The {where} placeholder is empty for the whole items query,
+    # and VOLUME_RANGE_FILTER for the VolumeID ranges used by --jobs.
+    VOLUME_RANGE_FILTER = "WHERE (? IS NULL OR b.VolumeID >= ?) AND (? IS NULL OR b.VolumeID < ?)"
+
+    QUERY_ITEMS_V175_TEMPLATE = """
         SELECT 
             b.VolumeID, 
             b.Text, 
@@ -377,11 +429,15 @@ class ExportKobo(CommandLineTool):
             b.BookmarkID
         FROM Bookmark b INNER JOIN content c
         ON b.VolumeID = c.BookID 
+        {where}
         GROUP BY b.DateCreated 
         ORDER BY b.ChapterProgress ASC, b.DateCreated ASC;
     """
 
-    QUERY_ITEMS_V174 = """
+    QUERY_ITEMS_V175 = QUERY_ITEMS_V175_TEMPLATE.format(where="")
+    QUERY_ITEMS_V175_RANGE = QUERY_ITEMS_V175_TEMPLATE.format(where=VOLUME_RANGE_FILTER)
+
+    QUERY_ITEMS_V174_TEMPLATE = """
         SELECT 
             b.VolumeID, 
             b.Text, 
@@ -395,10 +451,14 @@ class ExportKobo(CommandLineTool):
             b.BookmarkID
         FROM Bookmark b LEFT JOIN content c
         ON b.ContentID = c.ContentID 
+        {where}
         GROUP BY b.DateCreated 
         ORDER BY b.ChapterProgress ASC, b.DateCreated ASC;
     """
 
+    QUERY_ITEMS_V174 = QUERY_ITEMS_V174_TEMPLATE.format(where="")
+    QUERY_ITEMS_V174_RANGE = QUERY_ITEMS_V174_TEMPLATE.format(where=VOLUME_RANGE_FILTER)
+
     QUERY_BOOKS = """
         SELECT DISTINCT
             b.VolumeID,
@@ -412,10 +472,99 @@ class ExportKobo(CommandLineTool):
             c.Title;
     """
 
+    # Schema of the SQLite output (--sqlite-out).
+    # Items are keyed on the Kobo BookmarkID, so that exporting again
+    # into the same file updates the existing rows instead of duplicating them.
+    SCHEMA_SQLITE_OUT = """
+        CREATE TABLE IF NOT EXISTS books (
+            id INTEGER PRIMARY KEY,
+            volumeid TEXT NOT NULL UNIQUE,
+            title TEXT,
+            author TEXT
+        );
+        CREATE TABLE IF NOT EXISTS chapters (
+            id INTEGER PRIMARY KEY,
+            book_id INTEGER NOT NULL REFERENCES books(id),
+            title TEXT NOT NULL,
+            UNIQUE (book_id, title)
+        );
+        CREATE TABLE IF NOT EXISTS items (
+            bookmarkid TEXT PRIMARY KEY,
+            book_id INTEGER NOT NULL REFERENCES books(id),
+            chapter_id INTEGER REFERENCES chapters(id),
+            kind INTEGER NOT NULL,
+            text TEXT,
+            annotation TEXT,
+            datecreated TEXT,
+            datemodified TEXT,
+            created INTEGER,
+            modified INTEGER
+        );
+        CREATE INDEX IF NOT EXISTS idx_items_book ON items (book_id, created);
+        CREATE INDEX IF NOT EXISTS idx_items_chapter ON items (chapter_id);
+        CREATE INDEX IF NOT EXISTS idx_items_kind ON items (kind);
+        CREATE INDEX IF NOT EXISTS idx_items_created ON items (created);
+    """
+
+    UPSERT_BOOKS = """
+        INSERT INTO books (volumeid, title, author) VALUES (?, ?, ?)
+        ON CONFLICT (volumeid) DO UPDATE SET
+            title = excluded.title,
+            author = excluded.author;
+    """
+
+    UPSERT_CHAPTERS = """
+        INSERT INTO chapters (book_id, title) VALUES (?, ?)
+        ON CONFLICT (book_id, title) DO NOTHING;
+    """
+
+    UPSERT_ITEMS = """
+        INSERT INTO items (
+            bookmarkid, book_id, chapter_id, kind, text, annotation,
+            datecreated, datemodified, created, modified
+        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (bookmarkid) DO UPDATE SET
+            book_id = excluded.book_id,
+            chapter_id = excluded.chapter_id,
+            kind = excluded.kind,
+            text = excluded.text,
+            annotation = excluded.annotation,
+            datecreated = excluded.datecreated,
+            datemodified = excluded.datemodified,
+            created = excluded.created,
+            modified = excluded.modified;
+    """
+
+    # Used by --jobs to split the items query into VolumeID ranges,
+    # the bounds being NULL for the first and the last range.
+    QUERY_VOLUME_COUNTS = """
+        SELECT VolumeID, COUNT(*)
+        FROM Bookmark
+        WHERE VolumeID IS NOT NULL
+        GROUP BY VolumeID
+        ORDER BY VolumeID;
+    """
+
+    QUERY_NULL_VOLUMES = "SELECT COUNT(*) FROM Bookmark WHERE VolumeID IS NULL;"
+
+    QUERY_SHARED_DATES = """
+        SELECT 1
+        FROM Bookmark
+        GROUP BY DateCreated
+        HAVING COUNT(DISTINCT VolumeID) > 1
+        LIMIT 1;
+    """
+
+    # Number of VolumeID ranges per process, more ranges than processes
+    # keep the workers busy when the books have very different sizes.
+    PARTITIONS_PER_JOB = 4
+
     def __init__(self):
         super(ExportKobo, self).__init__()
         self.books = []
         self.items = []
+        # {BookmarkID: (DateCreated, DateModified)} as read from the db, NULL included
+        self.raw_dates = {}
         self.db_version = 0
 
     def run_command(self):
@@ -427,6 +576,14 @@ class ExportKobo(CommandLineTool):
         """
         if self.vargs["db"] is None:
             self.error("You must specify a valid path to your KoboReader.sqlite file.")
+        if self.vargs["sqlite_out"] is not None:
+            for name in ["ui", "list", "output", "info", "csv", "json", "markdown", "kindle", "raw", "add_chapter_headings"]:
+                if self.vargs[name] not in (None, False):
+                    self.error("You cannot specify both --sqlite-out and --{}.".format(name.replace("_", "-")))
+            if self.vargs["jobs"] != 1:
+                self.error("You cannot specify both --sqlite-out and --jobs.")
+            if os.path.exists(self.vargs["sqlite_out"]) and os.path.exists(self.vargs["db"]) and os.path.samefile(self.vargs["sqlite_out"], self.vargs["db"]):
+                self.error("You cannot specify the KoboReader.sqlite file as --sqlite-out.")
 
         # read db version
         self.read_db_version()
@@ -455,21 +612,25 @@ class ExportKobo(CommandLineTool):
                     output = "\n".join([frmt(v) for v in output])
             else:
                 # export: annotations and/or highlights
-                self.read_items(dict_books, enum_books)
-
-                if self.vargs["kindle"]:
-                    output = "\n".join([i.kindle_my_clippings() for i in self.items])
-                elif self.vargs["json"]:
-                    output = json.dumps(self.items, default=lambda o: o.__dict__, indent=2)
-                elif self.vargs["csv"]:
-                    output = self.list_to_csv([i.csv_tuple() for i in self.items])
-                elif self.vargs["markdown"]:
-                    output = self.list_to_markdown(enum_books)
-                elif self.vargs["raw"]:
-                    output = "\n".join([("{}\n".format(i.text)) for i in self.items])
-                else:
-                    # human-readable format
-                    output = "\n".join([("{}\n".format(i)) for i in self.items])
+                parallel_format = self.parallel_format()
+                output = None
+
+                if parallel_format is not None:
+                    output = self.render_items_parallel(parallel_format, dict_books, enum_books)
+                if output is None:
+                    self.read_items(dict_books, enum_books)
+
+                    if self.vargs["sqlite_out"] is not None:
+                        self.write_sqlite(dict_books)
+                        return
+
+                    item_format = self.item_format()
+                    if item_format is None:
+                        output = self.list_to_markdown(enum_books)
+                    else:
+                        # kindle, JSON, CSV, raw or human-readable format
+                        render = ITEM_RENDERERS[item_format]
+                        output = join_items(item_format, [render(i) for i in self.items])
 
             if self.vargs["output"] is not None:
                 # write to file
@@ -586,7 +747,8 @@ class ExportKobo(CommandLineTool):
                     last_entry = i
         return output
 
-    def list_to_csv(self, data):
+    @staticmethod
+    def list_to_csv(data):
         """
         Convert the given Item data into a well-formed CSV string.
         """
@@ -599,6 +761,53 @@ class ExportKobo(CommandLineTool):
                 writer.writerow(tuple([(v.encode("ascii", errors="replace") if v is not None else "") for v in d]))
         return output.getvalue()
 
+    def write_sqlite(self, dict_books):
+        """
+        Write the books and the current items into the SQLite file
+        given with ``--sqlite-out``, creating the schema if needed.
+
+        Existing rows are updated in place (keyed on volumeid for books
+        and on BookmarkID for items), so the file can be loaded incrementally.
+        Missing Kobo dates are written as NULL, not as the 1970 placeholder of Item.
+        """
+        try:
+            with contextlib.closing(sqlite3.connect(self.vargs["sqlite_out"])) as sql_connection:
+                with sql_connection:
+                    sql_connection.executescript(self.SCHEMA_SQLITE_OUT)
+                with sql_connection:
+                    sql_connection.executemany(
+                        self.UPSERT_BOOKS,
+                        [(b.volumeid, b.title, b.author) for b in dict_books.values()]
+                    )
+                    book_ids = dict(sql_connection.execute("SELECT volumeid, id FROM books;"))
+                    sql_connection.executemany(
+                        self.UPSERT_CHAPTERS,
+                        {(book_ids[i.volumeid], i.chapter) for i in self.items if i.chapter is not None}
+                    )
+                    chapter_ids = {
+                        (book_id, title): chapter_id
+                        for (chapter_id, book_id, title) in sql_connection.execute("SELECT id, book_id, title FROM chapters;")
+                    }
+                    rows = []
+                    for i in self.items:
+                        datecreated, datemodified = self.raw_dates[i.bookmarkid]
+                        book_id = book_ids[i.volumeid]
+                        rows.append((
+                            i.bookmarkid,
+                            book_id,
+                            chapter_ids.get((book_id, i.chapter)),
+                            Item.KIND_CODES[i.kind],
+                            i.text,
+                            i.annotation,
+                            datecreated,
+                            datemodified,
+                            Item.parse_timestamp(datecreated),
+                            Item.parse_timestamp(datemodified),
+                        ))
+                    sql_connection.executemany(self.UPSERT_ITEMS, rows)
+        except sqlite3.Error as exc:
+            self.error("Unable to write the SQLite output file: {}".format(exc))
+
     def read_books(self):
         """
         Return the list of books into two formats:
@@ -642,9 +851,8 @@ class ExportKobo(CommandLineTool):
         """
         # Creating a new Item with the relative Book for extract title+author coming from the other table
         items = []
-        print(self.db_version)
-        db_query = self.QUERY_ITEMS_V175 if self.db_version and self.db_version == 175 else self.QUERY_ITEMS_V174
-        for item in self.query(db_query):
+        for item in self.query(self.items_query()):
+            self.raw_dates[item[9]] = (item[3], item[4])
             volumeId = item[0]
             book = dict_books.get(volumeId)
             items.append(Item(item, book))
@@ -665,6 +873,111 @@ class ExportKobo(CommandLineTool):
         # Set items into the object
         self.items = items
 
+    def items_query(self, ranged=False):
+        """
+        Returns the items query matching the database version,
+        restricted to a VolumeID range if ``ranged`` is True.
+        """
+        if self.db_version and self.db_version == 175:
+            return self.QUERY_ITEMS_V175_RANGE if ranged else self.QUERY_ITEMS_V175
+        return self.QUERY_ITEMS_V174_RANGE if ranged else self.QUERY_ITEMS_V174
+
+    def parallel_format(self):
+        """
+        Returns the output format to render with ``--jobs``,
+        or None if the export must run in a single process.
+        """
+        if self.vargs["jobs"] is None or self.vargs["jobs"] < 2:
+            return None
+        if self.vargs["sqlite_out"] is not None or self.vargs["info"] or self.vargs["book"] is not None:
+            return None
+        return self.item_format()
+
+    def item_format(self):
+        """
+        Returns the requested output format if it is made of
+        independently formatted items (see ``ITEM_RENDERERS``),
+        or None for the Markdown format.
+        """
+        if self.vargs["kindle"]:
+            return "kindle"
+        if self.vargs["json"]:
+            return "json"
+        if self.vargs["csv"]:
+            return "csv"
+        if self.vargs["markdown"]:
+            return None
+        if self.vargs["raw"]:
+            return "raw"
+        return "human"
+
+    def volume_ranges(self, partitions):
+        """
+        Split the VolumeIDs into at most ``partitions`` contiguous ranges
+        with about the same number of items.
+        Returns a list of ``(first VolumeID, next range first VolumeID)``,
+        the first range having None as lower bound
+        and the last range having None as upper bound.
+        """
+        counts = self.query(self.QUERY_VOLUME_COUNTS)
+        if not counts:
+            return []
+        target = sum(c for (_, c) in counts) / partitions
+        starts = [None]
+        size = 0
+        for (volumeid, count) in counts:
+            if size >= target:
+                starts.append(volumeid)
+                size = 0
+            size += count
+        return list(zip(starts, starts[1:] + [None]))
+
+    def render_items_parallel(self, frmt, dict_books, enum_books):
+        """
+        Build and format the items with a pool of ``--jobs`` processes,
+        each one handling a VolumeID range of the items query.
+
+        The partial outputs are merged back with the ORDER BY of the items query,
+        so that the output is the same as the one of a single process.
+
+        Returns None when the items cannot be split without changing the output,
+        and the caller must fall back to a single process:
+        when some items have no VolumeID, or when items of different books
+        share the same DateCreated (the GROUP BY of the whole query
+        would keep only one of them, picked by SQLite).
+        Both are checked with a query before starting the workers,
+        and the merge checks the DateCreated values again.
+        """
+        if self.query(self.QUERY_NULL_VOLUMES)[0][0] > 0:
+            return None
+        if self.query(self.QUERY_SHARED_DATES):
+            return None
+        volumeid = self.volumeid_from_bookid(enum_books) if self.vargs["bookid"] is not None else None
+        jobs = self.vargs["jobs"]
+        query = self.items_query(ranged=True)
+        tasks = [(query, (lo, lo, hi, hi)) for (lo, hi) in self.volume_ranges(jobs * self.PARTITIONS_PER_JOB)]
+        filters = (volumeid, self.vargs["highlights_only"], self.vargs["annotations_only"])
+        try:
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=jobs,
+                initializer=init_partition_worker,
+                initargs=(self.vargs["db"], dict_books, frmt, filters)
+            ) as executor:
+                partials = list(executor.map(render_partition, tasks))
+        except sqlite3.Error as exc:
+            self.error("Unexpected error reading your KoboReader.sqlite file: {}".format(exc))
+
+        chunks = []
+        seen = set()
+        for (_, datecreated, chunk) in heapq.merge(*partials, key=lambda r: r[0]):
+            if datecreated in seen:
+                return None
+            seen.add(datecreated)
+            if chunk is not None:
+                chunks.append(chunk)
+
+        return join_items(frmt, chunks)
+
     def query(self, query, fetchone=False):
         """
         Run the given query over the SQLite file.
@@ -688,6 +1001,87 @@ class ExportKobo(CommandLineTool):
         return data
 
 
+# Per-process state of the --jobs workers, set by init_partition_worker()
+partition_worker = None
+
+# Format a single Item, for each of the formats made of independent items.
+# The output is the join_items() of the formatted items,
+# both in a single process and with --jobs.
+ITEM_RENDERERS = {
+    "kindle": lambda i: i.kindle_my_clippings(),
+    "json": lambda i: json.dumps(i, default=lambda o: o.__dict__, indent=2),
+    "csv": lambda i: ExportKobo.list_to_csv([i.csv_tuple()]),
+    "raw": lambda i: "{}\n".format(i.text),
+    "human": lambda i: "{}\n".format(i),
+}
+
+
+def join_items(frmt, chunks):
+    """
+    Join the items formatted with ``ITEM_RENDERERS[frmt]`` into the output.
+    """
+    if frmt == "csv":
+        return "".join(chunks)
+    if frmt == "json":
+        # same as json.dumps() of the list of items with indent=2
+        if not chunks:
+            return "[]"
+        return "[\n" + ",\n".join([textwrap.indent(c, "  ") for c in chunks]) + "\n]"
+    return "\n".join(chunks)
+
+
+def sqlite_sort_key(value):
+    """
+    Returns a key sorting Python values like SQLite sorts column values:
+    NULL first, then numbers, text and blobs.
+    """
+    if value is None:
+        return (0, 0)
+    if isinstance(value, (int, float)):
+        return (1, value)
+    if isinstance(value, str):
+        return (2, value)
+    return (3, value)
+
+
+def init_partition_worker(db_path, dict_books, frmt, filters):
+    """
+    Initialize a --jobs worker process, once per process.
+    """
+    global partition_worker
+    partition_worker = (db_path, dict_books, frmt, filters)
+
+
+def render_partition(task):
+    """
+    Run the items query over a VolumeID range, then build and format its items.
+
+    Returns a list of ``(sort key, DateCreated, formatted item)``
+    in the order of the query, the formatted item being None
+    for the items excluded by the filters.
+    """
+    query, params = task
+    db_path, dict_books, frmt, (volumeid, highlights_only, annotations_only) = partition_worker
+    render = ITEM_RENDERERS[frmt]
+    sql_connection = sqlite3.connect(db_path)
+    try:
+        rows = sql_connection.execute(query, params).fetchall()
+    finally:
+        sql_connection.close()
+
+    output = []
+    for row in rows:
+        item = Item(row, dict_books.get(row[0]))
+        keep = (
+            (volumeid is None or item.volumeid == volumeid)
+            and (not highlights_only or item.kind == Item.HIGHLIGHT)
+            and (not annotations_only or item.kind == Item.ANNOTATION)
+        )
+        key = (sqlite_sort_key(row[5]), sqlite_sort_key(row[3]))
+        output.append((key, row[3], render(item) if keep else None))
+    return output
+
+
 if __name__ == "__main__":
     book_manager = ExportKobo()
     book_manager.run()